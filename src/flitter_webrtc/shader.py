@@ -16,6 +16,8 @@ from flitter.render.window import ProgramNode
 from flitter.render.window.glconstants import GL_FRAMEBUFFER_SRGB
 from flitter.render.window.target import RenderTarget
 
+from .sync import StateSync
+
 
 Reformatter = VideoReformatter()
 
@@ -101,6 +103,9 @@ class WebRTC(ProgramNode):
         super().__init__(glctx)
         self._signalling = None
         self._peer_connection = None
+        self._channel = None
+        self._channel_attribute = None
+        self._state_sync = None
         self._remote_track_task = None
         self._remote_frame = None
         self._remote_target = None
@@ -132,8 +137,21 @@ class WebRTC(ProgramNode):
 
     async def create(self, engine, node, resized, **kwargs):
         self._signalling_class_node = None, None
-        if resized:
+        default_channel = 'unordered' if 'sync' in node else None
+        channel = node.get('channel', 1, str, default_channel)
+        if channel not in ('ordered', 'unordered', None):
+            if channel != self._channel_attribute:
+                logger.warning("Unrecognised WebRTC channel '{}'; using default", channel)
+            self._channel_attribute = channel
+            channel = default_channel
+        else:
+            self._channel_attribute = channel
+        if resized or channel != self._channel:
+            self._channel = channel
             await self.reset_connection()
+        if self._state_sync is not None:
+            keys = [Vector(key) for key in node['sync']] if 'sync' in node else []
+            self._state_sync.update(engine.state, keys)
         if 'state' in node:
             if self._peer_connection is not None:
                 engine.state[node['state']] = Vector.symbol(self._peer_connection.connectionState)
@@ -190,6 +208,10 @@ class WebRTC(ProgramNode):
         self._peer_connection.add_listener('track', self.add_remote_track)
         self._peer_connection.add_listener('connectionstatechange', self.connection_state_change)
         self._peer_connection.addTrack(RenderTrack(self))
+        if self._channel is not None:
+            ordered = self._channel == 'ordered'
+            channel = self._peer_connection.createDataChannel('state', ordered=ordered, maxRetransmits=None if ordered else 0, negotiated=True, id=0)
+            self._state_sync = StateSync(channel, ordered)
         return self._peer_connection
 
     @property
@@ -199,6 +221,8 @@ class WebRTC(ProgramNode):
     async def create_offer(self):
         offer = await self._peer_connection.createOffer()
         await self._peer_connection.setLocalDescription(offer)
+        if self._state_sync is not None:
+            self._state_sync.leader = True
 
     @property
     def offer(self):
@@ -228,6 +252,9 @@ class WebRTC(ProgramNode):
         if self._remote_target is not None:
             self._remote_target.release()
             self._remote_target = None
+        if self._state_sync is not None:
+            self._state_sync.channel.remove_all_listeners()
+            self._state_sync = None
         if self._peer_connection is not None:
             self._peer_connection.remove_all_listeners()
             await self._peer_connection.close()
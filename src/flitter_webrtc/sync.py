@@ -0,0 +1,174 @@
+"""
+Flitter WebRTC state synchronisation
+"""
+
+import struct
+import time
+
+from loguru import logger
+
+from flitter.model import Vector, null
+
+
+class StateSync:
+    COUNT = struct.Struct('!H')
+    CLOCK = struct.Struct('!I')
+    NUMBER = struct.Struct('!d')
+    NUMERIC = 0
+    MIXED = 1
+    STRING = 2
+    MAX_COUNT = 65535
+    MAX_MESSAGE_SIZE = 65536
+    SNAPSHOT_INTERVAL = 1
+
+    def __init__(self, channel, ordered):
+        self.channel = channel
+        self.ordered = ordered
+        self.leader = False
+        self.clocks = {}
+        self.values = {}
+        self.sent = {}
+        self.published = set()
+        self.unencodable = {}
+        self.last_snapshot = None
+        self.received = {}
+        self.channel.add_listener('open', self.channel_open)
+        self.channel.add_listener('message', self.receive)
+
+    def channel_open(self):
+        logger.debug("WebRTC {} state channel open", 'ordered' if self.ordered else 'unordered')
+        self.last_snapshot = None
+
+    @classmethod
+    def encode_vector(cls, vector):
+        n = len(vector)
+        if n > cls.MAX_COUNT:
+            raise ValueError(f"Vector length {n} exceeds maximum of {cls.MAX_COUNT}")
+        if vector.numeric:
+            return bytes([cls.NUMERIC]) + cls.COUNT.pack(n) + struct.pack(f'!{n}d', *vector)
+        parts = [bytes([cls.MIXED]), cls.COUNT.pack(n)]
+        for item in vector:
+            if isinstance(item, float):
+                parts.append(bytes([cls.NUMERIC]))
+                parts.append(cls.NUMBER.pack(item))
+            elif isinstance(item, str):
+                data = item.encode('utf8')
+                if len(data) > cls.MAX_COUNT:
+                    raise ValueError(f"String length {len(data)} exceeds maximum of {cls.MAX_COUNT} bytes")
+                parts.append(bytes([cls.STRING]))
+                parts.append(cls.COUNT.pack(len(data)))
+                parts.append(data)
+            else:
+                raise TypeError(f"Cannot encode {type(item).__name__} value")
+        return b''.join(parts)
+
+    @classmethod
+    def decode_vector(cls, data, offset):
+        kind = data[offset]
+        n, = cls.COUNT.unpack_from(data, offset + 1)
+        offset += 1 + cls.COUNT.size
+        if kind == cls.NUMERIC:
+            values = struct.unpack_from(f'!{n}d', data, offset)
+            return Vector(values), offset + n * cls.NUMBER.size
+        if kind != cls.MIXED:
+            raise ValueError(f"Unknown vector type {kind}")
+        values = []
+        for i in range(n):
+            kind = data[offset]
+            offset += 1
+            if kind == cls.NUMERIC:
+                values.append(cls.NUMBER.unpack_from(data, offset)[0])
+                offset += cls.NUMBER.size
+            elif kind == cls.STRING:
+                length, = cls.COUNT.unpack_from(data, offset)
+                offset += cls.COUNT.size
+                if offset + length > len(data):
+                    raise ValueError("Truncated string")
+                values.append(data[offset:offset+length].decode('utf8'))
+                offset += length
+            else:
+                raise ValueError(f"Unknown item type {kind}")
+        return Vector(values), offset
+
+    @classmethod
+    def encode_entry(cls, key, clock, value):
+        data = cls.encode_vector(key) + cls.CLOCK.pack(clock) + cls.encode_vector(value)
+        if len(data) > cls.MAX_MESSAGE_SIZE:
+            raise ValueError(f"Encoded size {len(data)} exceeds maximum of {cls.MAX_MESSAGE_SIZE} bytes")
+        return data
+
+    @classmethod
+    def decode_message(cls, data):
+        entries = []
+        offset = 0
+        while offset < len(data):
+            key, offset = cls.decode_vector(data, offset)
+            clock, = cls.CLOCK.unpack_from(data, offset)
+            value, offset = cls.decode_vector(data, offset + cls.CLOCK.size)
+            entries.append((key, clock, value))
+        return entries
+
+    def receive(self, data):
+        if not isinstance(data, bytes):
+            return
+        try:
+            entries = self.decode_message(data)
+        except (struct.error, IndexError, ValueError):
+            logger.warning("Ignoring badly encoded state message")
+            return
+        for key, clock, value in entries:
+            if key not in self.received or clock >= self.received[key][0]:
+                self.received[key] = clock, value
+
+    def update(self, state, keys):
+        keys = set(keys)
+        changed = set()
+        for key in keys:
+            value = state[key]
+            if value != self.values.get(key, null):
+                self.clocks[key] = self.clocks.get(key, 0) + 1
+                self.values[key] = value
+            if value != self.sent.get(key, null):
+                changed.add(key)
+        for key, (clock, value) in self.received.items():
+            if key not in keys:
+                logger.debug("Ignoring received value for unshared state key {!r}", key)
+                continue
+            local_clock = self.clocks.get(key, 0)
+            if clock < local_clock or (clock == local_clock and self.leader):
+                continue
+            self.clocks[key] = clock
+            state[key] = value
+            self.values[key] = value
+            self.sent[key] = value
+            self.published.discard(key)
+            changed.discard(key)
+        self.received.clear()
+        if self.channel.readyState != 'open':
+            return
+        now = time.monotonic()
+        if self.last_snapshot is None or (not self.ordered and now > self.last_snapshot + self.SNAPSHOT_INTERVAL):
+            self.last_snapshot = now
+            changed.update(self.published & keys)
+        parts = []
+        size = 0
+        for key in changed:
+            value = state[key]
+            try:
+                data = self.encode_entry(key, self.clocks[key], value)
+            except (TypeError, ValueError) as exc:
+                if key not in self.unencodable or value != self.unencodable[key]:
+                    logger.warning("Unable to share state key {!r}: {}", key, str(exc))
+                    self.unencodable[key] = value
+                continue
+            self.unencodable.pop(key, None)
+            self.sent[key] = value
+            self.published.add(key)
+            if size + len(data) > self.MAX_MESSAGE_SIZE:
+                self.channel.send(b''.join(parts))
+                parts = []
+                size = 0
+            parts.append(data)
+            size += len(data)
+        if parts:
+            self.channel.send(b''.join(parts))
@@ -0,0 +1,245 @@
+"""
+Tests for WebRTC state synchronisation encoding and conflict resolution
+"""
+
+import pytest
+
+from flitter.model import Vector, StateDict, Node, null
+
+from flitter_webrtc.sync import StateSync
+
+
+class FakeChannel:
+    def __init__(self, ready_state='open'):
+        self.readyState = ready_state
+        self.messages = []
+
+    def add_listener(self, event, handler):
+        pass
+
+    def send(self, data):
+        self.messages.append(data)
+
+
+BEAT = Vector.symbol('beat')
+CUE = Vector.symbol('cue')
+
+
+def make_pair(ordered=True):
+    a = StateSync(FakeChannel(), ordered)
+    a.leader = True
+    b = StateSync(FakeChannel(), ordered)
+    return a, b
+
+
+def deliver(source, destination):
+    for message in source.channel.messages:
+        destination.receive(message)
+    source.channel.messages.clear()
+
+
+@pytest.mark.parametrize('vector', [
+    Vector([1.0, 2.5, -3.0]),
+    Vector(['hello', 1.5, 'wörld']),
+    Vector(['']),
+    Vector.symbol('foo'),
+    Vector(['x', Vector.symbol('y')[0]]),
+    null,
+])
+def test_vector_round_trip(vector):
+    data = StateSync.encode_vector(vector)
+    decoded, offset = StateSync.decode_vector(data, 0)
+    assert decoded == vector
+    assert offset == len(data)
+
+
+def test_encode_rejects_objects():
+    with pytest.raises(TypeError):
+        StateSync.encode_vector(Vector([Node('foo')]))
+
+
+def test_encode_rejects_oversized():
+    with pytest.raises(ValueError):
+        StateSync.encode_vector(Vector(list(range(StateSync.MAX_COUNT + 1))))
+    with pytest.raises(ValueError):
+        StateSync.encode_vector(Vector(['x' * (StateSync.MAX_COUNT + 1)]))
+    with pytest.raises(ValueError):
+        StateSync.encode_entry(BEAT, 1, Vector(list(range(10000))))
+
+
+def test_message_round_trip():
+    data = StateSync.encode_entry(BEAT, 3, Vector(1.5)) + StateSync.encode_entry(CUE, 7, Vector('go'))
+    assert StateSync.decode_message(data) == [(BEAT, 3, Vector(1.5)), (CUE, 7, Vector('go'))]
+
+
+@pytest.mark.parametrize('data', [
+    b'\x00',
+    b'\x00\x00\x02' + b'\x00' * 12,
+    b'\x05\x00\x01',
+    b'\x01\x00\x01\x07',
+    b'\x01\x00\x01\x02\x00\x10abc',
+    StateSync.encode_entry(BEAT, 1, Vector(1.0))[:-1],
+    StateSync.encode_entry(BEAT, 1, Vector(1.0)) + b'\x00',
+])
+def test_receive_ignores_malformed(data):
+    sync = StateSync(FakeChannel(), True)
+    sync.receive(data)
+    assert sync.received == {}
+
+
+def test_sync_values():
+    a, b = make_pair()
+    state_a, state_b = StateDict(), StateDict()
+    state_a[BEAT] = Vector(4)
+    a.update(state_a, [BEAT])
+    assert len(a.channel.messages) == 1
+    deliver(a, b)
+    b.update(state_b, [BEAT])
+    assert state_b[BEAT] == Vector(4)
+    assert b.channel.messages == []
+    a.update(state_a, [BEAT])
+    assert a.channel.messages == []
+
+
+def test_coalesced_into_one_message():
+    a, b = make_pair()
+    state_a, state_b = StateDict(), StateDict()
+    state_a[BEAT] = Vector(1)
+    state_a[CUE] = Vector('go')
+    a.update(state_a, [BEAT, CUE])
+    assert len(a.channel.messages) == 1
+    deliver(a, b)
+    b.update(state_b, [BEAT, CUE])
+    assert state_b[BEAT] == Vector(1)
+    assert state_b[CUE] == Vector('go')
+
+
+def test_split_large_messages():
+    a, b = make_pair()
+    state_a, state_b = StateDict(), StateDict()
+    keys = [Vector(f'key{i}') for i in range(20)]
+    for key in keys:
+        state_a[key] = Vector(list(range(1000)))
+    a.update(state_a, keys)
+    assert len(a.channel.messages) > 1
+    assert all(len(message) <= StateSync.MAX_MESSAGE_SIZE for message in a.channel.messages)
+    deliver(a, b)
+    b.update(state_b, keys)
+    for key in keys:
+        assert state_b[key] == state_a[key]
+
+
+def test_unencodable_does_not_block_other_keys():
+    a, b = make_pair()
+    state_a, state_b = StateDict(), StateDict()
+    state_a[BEAT] = Vector(list(range(70000)))
+    state_a[CUE] = Vector(1)
+    a.update(state_a, [BEAT, CUE])
+    deliver(a, b)
+    b.update(state_b, [BEAT, CUE])
+    assert state_b[CUE] == Vector(1)
+    assert state_b[BEAT] == null
+
+
+def test_ignore_unshared_keys():
+    a, b = make_pair()
+    state_a, state_b = StateDict(), StateDict()
+    state_a[BEAT] = Vector(1)
+    state_a[CUE] = Vector(2)
+    a.update(state_a, [BEAT, CUE])
+    deliver(a, b)
+    b.update(state_b, [BEAT])
+    assert state_b[BEAT] == Vector(1)
+    assert state_b[CUE] == null
+
+
+def test_drop_out_of_order():
+    a, b = make_pair(ordered=False)
+    state_a, state_b = StateDict(), StateDict()
+    for value in (1, 2, 3):
+        state_a[BEAT] = Vector(value)
+        a.update(state_a, [BEAT])
+    messages = list(reversed(a.channel.messages))
+    for message in messages:
+        b.receive(message)
+    b.update(state_b, [BEAT])
+    assert state_b[BEAT] == Vector(3)
+    b.receive(messages[1])
+    b.update(state_b, [BEAT])
+    assert state_b[BEAT] == Vector(3)
+
+
+def test_concurrent_publishers_converge():
+    a, b = make_pair(ordered=False)
+    state_a, state_b = StateDict(), StateDict()
+    state_a[CUE] = Vector(5)
+    state_b[CUE] = Vector(6)
+    a.update(state_a, [CUE])
+    b.update(state_b, [CUE])
+    deliver(a, b)
+    deliver(b, a)
+    a.update(state_a, [CUE])
+    b.update(state_b, [CUE])
+    assert state_a[CUE] == Vector(5)
+    assert state_b[CUE] == Vector(5)
+    a.last_snapshot = b.last_snapshot = 0
+    a.update(state_a, [CUE])
+    b.update(state_b, [CUE])
+    assert len(a.channel.messages) == 1
+    assert b.channel.messages == []
+    deliver(a, b)
+    b.update(state_b, [CUE])
+    assert state_b[CUE] == Vector(5)
+
+
+def test_later_change_wins():
+    a, b = make_pair()
+    state_a, state_b = StateDict(), StateDict()
+    state_a[CUE] = Vector(1)
+    a.update(state_a, [CUE])
+    deliver(a, b)
+    b.update(state_b, [CUE])
+    state_b[CUE] = Vector(2)
+    b.update(state_b, [CUE])
+    deliver(b, a)
+    a.update(state_a, [CUE])
+    assert state_a[CUE] == Vector(2)
+
+
+def test_snapshot_resends_published():
+    a, b = make_pair(ordered=False)
+    state_a, state_b = StateDict(), StateDict()
+    state_a[BEAT] = Vector(1)
+    a.update(state_a, [BEAT])
+    a.channel.messages.clear()
+    a.update(state_a, [BEAT])
+    assert a.channel.messages == []
+    a.last_snapshot = 0
+    a.update(state_a, [BEAT])
+    deliver(a, b)
+    b.update(state_b, [BEAT])
+    assert state_b[BEAT] == Vector(1)
+
+
+def test_no_snapshot_when_ordered():
+    a, _ = make_pair(ordered=True)
+    state_a = StateDict()
+    state_a[BEAT] = Vector(1)
+    a.update(state_a, [BEAT])
+    a.channel.messages.clear()
+    a.last_snapshot = 0
+    a.update(state_a, [BEAT])
+    assert a.channel.messages == []
+
+
+def test_no_send_until_open():
+    sync = StateSync(FakeChannel('connecting'), True)
+    state = StateDict()
+    state[BEAT] = Vector(1)
+    sync.update(state, [BEAT])
+    sync.update(state, [BEAT])
+    assert sync.channel.messages == []
+    sync.channel.readyState = 'open'
+    sync.update(state, [BEAT])
+    assert len(sync.channel.messages) == 1
+    assert StateSync.decode_message(sync.channel.messages[0]) == [(BEAT, 1, Vector(1))]